@@ -307,7 +307,7 @@ class EvalHarnessAdapter(GPT2LM):
         # make a dummy dataloader / iterator to pass to model
         # we need to do this because deepspeed pipe parallel only takes an iterator
         # in this format
-        return iter([{"text": F.pad(inps, pad=(0, 1))}]), padded
+        return iter([{"text": F.pad(inps, pad=(0, 1)).int()}]), padded
 
     def _dp_gather(self, logits):
         """
@@ -25,6 +25,7 @@ import sys
 import numpy as np
 
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 from megatron import mpu
@@ -57,7 +58,7 @@ def do_forward_pass(neox_args, model, inference=False):
     # get context tokens
     # always forward full batch size
     context_tokens_tensor = (
-        torch.arange(neox_args.seq_length + 1)
+        torch.arange(neox_args.seq_length + 1, dtype=torch.int32)
         .repeat((neox_args.train_micro_batch_size_per_gpu, 1))
         .cuda()
     )
@@ -218,6 +219,90 @@ def save_checkpoint(neox_args, iteration, model, optimizer, lr_scheduler):
     torch.distributed.barrier()
 
 
+def _read_files(paths, chunk_size=64 * 1024 * 1024):
+    """Read `paths` front to back and throw the contents away, leaving them in the OS page cache."""
+    buffer = bytearray(chunk_size)
+    for path in paths:
+        try:
+            with open(path, "rb", buffering=0) as f:
+                while f.readinto(buffer):
+                    pass
+        except OSError:
+            # the actual load will report any problems with the checkpoint
+            pass
+
+
+def get_checkpoint_files(
+    checkpoint_dir,
+    pipe_rank,
+    model_rank,
+    model_parallel_size,
+    layer_indices=(),
+    load_optim=True,
+):
+    """
+    Returns the files in `checkpoint_dir` (a single tag / global_step directory) that deepspeed reads when loading
+    the checkpoint on a rank with the given pipe / model parallel coordinates. `layer_indices` are the indices of
+    the pipe layers that rank holds, if the model is pipe parallel. Files that don't exist are skipped.
+
+    Which data parallel rank it is doesn't matter - every rank reads the zero optimizer shards of all data
+    parallel ranks with the same pipe / model parallel coordinates, and repartitions them itself.
+    """
+    # deepspeed names the engine states by the rank within the combined pipe x model parallel group,
+    # and the pipe layer states by the model parallel rank alone
+    engine_rank = pipe_rank * model_parallel_size + model_rank
+    names = [f"mp_rank_{engine_rank:02d}_model_states.pt"]
+    names += [
+        f"layer_{idx:02d}-model_{model_rank:02d}-model_states.pt"
+        for idx in layer_indices
+    ]
+    paths = [os.path.join(checkpoint_dir, name) for name in names]
+    paths = [path for path in paths if os.path.isfile(path)]
+    if load_optim:
+        # (bf16_)zero_pp_rank_{data parallel rank}_mp_rank_{engine rank}_optim_states.pt
+        zero_pattern = f"*zero_pp_rank_*_mp_rank_{engine_rank:02d}_optim_states.pt"
+        paths += sorted(glob(os.path.join(checkpoint_dir, zero_pattern)))
+    return paths
+
+
+def prefetch_checkpoint(neox_args, model, iteration=None):
+    """
+    Start reading the files of the checkpoint that `load_checkpoint` will load on this rank into the OS page cache
+    on a background thread. `model` is the (not yet deepspeed wrapped) model from `get_model`.
+    Returns a future to wait on before loading the checkpoint, or None if there is nothing to prefetch.
+    """
+    if iteration is not None:
+        tag = f"global_step{iteration}"
+    else:
+        latest_path = os.path.join(neox_args.load, "latest")
+        if not os.path.isfile(latest_path):
+            return None
+        with open(latest_path, "r") as f:
+            tag = f.read().strip()
+
+    topo = mpu.get_topology()
+    coord = topo.get_coord(rank=torch.distributed.get_rank())
+    if neox_args.is_pipe_parallel:
+        layer_indices = range(model._local_start, model._local_stop)
+    else:
+        layer_indices = ()
+    paths = get_checkpoint_files(
+        checkpoint_dir=os.path.join(neox_args.load, tag),
+        pipe_rank=coord.pipe,
+        model_rank=coord.model,
+        model_parallel_size=topo.get_dim("model"),
+        layer_indices=layer_indices,
+        load_optim=not (neox_args.no_load_optim or neox_args.finetune),
+    )
+    if not paths:
+        return None
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(_read_files, paths)
+    executor.shutdown(wait=False)
+    return future
+
+
 def load_checkpoint(
     neox_args, model, optimizer, lr_scheduler, inference=False, iteration=None
 ):
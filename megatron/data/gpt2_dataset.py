@@ -100,7 +100,7 @@ class GPT2Dataset(torch.utils.data.Dataset):
                 )
                 sample = np.concatenate(sample_list)
 
-            return {"text": np.array(sample, dtype=np.int64)}
+            return {"text": np.array(sample, dtype=np.int32)}
         except IndexError:
             new_idx = idx % len(self)
             print(
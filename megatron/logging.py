@@ -17,7 +17,7 @@ import sys
 import torch
 import wandb
 from megatron import mpu, print_rank_0
-from megatron.utils import report_memory
+from megatron.utils import report_memory, reduce_losses
 
 
 class Tee:
@@ -87,6 +87,32 @@ def get_flops(neox_args, model, iter_time_s):
     return flops
 
 
+SKIPPED_ITERS_KEY = "skipped iterations"
+GOT_NAN_KEY = "got nan"
+
+
+def accumulate_losses(loss_dict, total_loss_dict, skipped_iter):
+    """
+    Add the losses of a single iteration to the running totals in `total_loss_dict`.
+
+    This is all that needs to happen on iterations that aren't logged - use it instead of `training_log` there.
+    """
+    total_loss_dict[SKIPPED_ITERS_KEY] = (
+        total_loss_dict.get(SKIPPED_ITERS_KEY, 0) + skipped_iter
+    )
+
+    got_nan = False
+    for key in loss_dict:
+        if not skipped_iter:
+            total_loss_dict[key] = total_loss_dict.get(key, 0.0) + loss_dict[key]
+        else:
+            value = loss_dict[key].float().sum().item()
+            is_nan = value == float("inf") or value == -float("inf") or value != value
+            got_nan = got_nan or is_nan
+
+    total_loss_dict[GOT_NAN_KEY] = total_loss_dict.get(GOT_NAN_KEY, 0) + int(got_nan)
+
+
 def training_log(
     neox_args,
     timers,
@@ -101,25 +127,35 @@ def training_log(
     optimizer,
     noise_scale_logger,
 ):
-    """Log training information such as losses, timing, etc."""
+    """
+    Log training information such as losses, timing, etc.
+
+    Only needs to be called on iterations that should be logged (see `accumulate_losses` for the others).
+    """
 
     # Update losses.
-    skipped_iters_key = "skipped iterations"
-    total_loss_dict[skipped_iters_key] = (
-        total_loss_dict.get(skipped_iters_key, 0) + skipped_iter
+    skipped_iters_key = SKIPPED_ITERS_KEY
+    got_nan_key = GOT_NAN_KEY
+    accumulate_losses(
+        loss_dict=loss_dict, total_loss_dict=total_loss_dict, skipped_iter=skipped_iter
     )
-    got_nan_key = "got nan"
-
-    got_nan = False
-    for key in loss_dict:
-        if not skipped_iter:
-            total_loss_dict[key] = total_loss_dict.get(key, 0.0) + loss_dict[key]
-        else:
-            value = loss_dict[key].float().sum().item()
-            is_nan = value == float("inf") or value == -float("inf") or value != value
-            got_nan = got_nan or is_nan
 
-    total_loss_dict[got_nan_key] = total_loss_dict.get(got_nan_key, 0) + int(got_nan)
+    # Average losses across machines. Training steps don't reduce their losses, so this is the only
+    # collective needed for them - the current iteration's and the interval totals go in a single one.
+    loss_keys = list(loss_dict.keys())
+    total_keys = [
+        key
+        for key in total_loss_dict
+        if key not in [skipped_iters_key, got_nan_key]
+        and torch.is_tensor(total_loss_dict[key])
+    ]
+    reduced = reduce_losses(
+        [loss_dict[key] for key in loss_keys]
+        + [total_loss_dict[key] for key in total_keys]
+    )
+    loss_dict = dict(zip(loss_keys, reduced[: len(loss_keys)]))
+    for key, value in zip(total_keys, reduced[len(loss_keys) :]):
+        total_loss_dict[key] = value
 
     # Logging.
     timers_to_log = []
@@ -129,19 +165,15 @@ def training_log(
             timers_to_log.append(name)
 
     if not neox_args.is_pipe_parallel:
-        add_to_logging("forward")
-        add_to_logging("backward")
+        add_to_logging("forward-backward")
         add_to_logging("backward-backward")
         add_to_logging("backward-allreduce")
         add_to_logging("backward-master-grad")
         add_to_logging("backward-clip-grad")
-        add_to_logging("optimizer")
         add_to_logging("batch generator")
 
         # Log timer info to tensorboard and wandb
-        normalizer = iteration % neox_args.log_interval
-        if normalizer == 0:
-            normalizer = neox_args.log_interval
+        normalizer = neox_args.log_interval
         if torch.distributed.get_rank() == 0:
             timers.write(
                 names=timers_to_log, iteration=iteration, normalizer=normalizer
@@ -167,7 +199,7 @@ def training_log(
                             tensorboard_writer=neox_args.tensorboard_writer,
                         )
 
-    # write losses, lr, etc. every step
+    # write losses, lr, etc. every logged step
     tb_wandb_log(
         "train/learning_rate",
         learning_rate,
@@ -203,7 +235,7 @@ def training_log(
                 tensorboard_writer=neox_args.tensorboard_writer,
             )
 
-    # (optional) Log optimizer states to wandb / tb every step
+    # (optional) Log optimizer states to wandb / tb every logged step
     if neox_args.log_optimizer_states:
         for k, v in optimizer.state_dict()["optimizer_state_dict"]["state"].items():
             for ki, vi in v.items():  # step, module
@@ -217,7 +249,7 @@ def training_log(
                         tensorboard_writer=neox_args.tensorboard_writer,
                     )
 
-    # (optional) Log grad/param norms to wandb / tb every step
+    # (optional) Log grad/param norms to wandb / tb every logged step
     if (
         neox_args.log_grad_pct_zeros
         or neox_args.log_grad_norm
@@ -267,78 +299,73 @@ def training_log(
                     all_ranks=True,
                 )
 
-    if iteration % neox_args.log_interval == 0:
-        # log other stuff every neox_args.log_interval iters
-        elapsed_time = timers("interval time").elapsed()
-        iteration_time = elapsed_time / neox_args.log_interval
-        samples_per_sec = neox_args.train_batch_size / iteration_time
-        log_string = " samples/sec: {:.3f} |".format(samples_per_sec)
-        tb_wandb_log(
-            "runtime/samples_per_sec",
-            samples_per_sec,
-            iteration,
-            use_wandb=neox_args.use_wandb,
-            tensorboard_writer=neox_args.tensorboard_writer,
-        )
-        tb_wandb_log(
-            "runtime/iteration_time",
-            iteration_time,
-            iteration,
-            use_wandb=neox_args.use_wandb,
-            tensorboard_writer=neox_args.tensorboard_writer,
-        )
-        log_string += " iteration {:8d}/{:8d} |".format(
-            iteration, neox_args.train_iters
-        )
-        log_string += " elapsed time per iteration (ms): {:.1f} |".format(
-            elapsed_time * 1000.0 / neox_args.log_interval
-        )
-        log_string += " learning rate: {:.3E} |".format(learning_rate)
-        num_iterations = max(
-            1, neox_args.log_interval - total_loss_dict[skipped_iters_key]
-        )
+    # log other stuff (training_log is only called every neox_args.log_interval iters)
+    elapsed_time = timers("interval time").elapsed()
+    iteration_time = elapsed_time / neox_args.log_interval
+    samples_per_sec = neox_args.train_batch_size / iteration_time
+    log_string = " samples/sec: {:.3f} |".format(samples_per_sec)
+    tb_wandb_log(
+        "runtime/samples_per_sec",
+        samples_per_sec,
+        iteration,
+        use_wandb=neox_args.use_wandb,
+        tensorboard_writer=neox_args.tensorboard_writer,
+    )
+    tb_wandb_log(
+        "runtime/iteration_time",
+        iteration_time,
+        iteration,
+        use_wandb=neox_args.use_wandb,
+        tensorboard_writer=neox_args.tensorboard_writer,
+    )
+    log_string += " iteration {:8d}/{:8d} |".format(iteration, neox_args.train_iters)
+    log_string += " elapsed time per iteration (ms): {:.1f} |".format(
+        elapsed_time * 1000.0 / neox_args.log_interval
+    )
+    log_string += " learning rate: {:.3E} |".format(learning_rate)
+    num_iterations = max(1, neox_args.log_interval - total_loss_dict[skipped_iters_key])
 
-        # log tflop / gpu
-        flops_per_s_per_gpu = get_flops(
-            neox_args=neox_args, model=model, iter_time_s=iteration_time
-        )
-        log_string += (
-            f" approx flops per GPU: {human_readable_flops(flops_per_s_per_gpu)} |"
-        )
-        tb_wandb_log(
-            "runtime/flops_per_sec_per_gpu",
-            flops_per_s_per_gpu,
-            iteration,
-            use_wandb=neox_args.use_wandb,
-            tensorboard_writer=neox_args.tensorboard_writer,
-        )
+    # log tflop / gpu
+    flops_per_s_per_gpu = get_flops(
+        neox_args=neox_args, model=model, iter_time_s=iteration_time
+    )
+    log_string += (
+        f" approx flops per GPU: {human_readable_flops(flops_per_s_per_gpu)} |"
+    )
+    tb_wandb_log(
+        "runtime/flops_per_sec_per_gpu",
+        flops_per_s_per_gpu,
+        iteration,
+        use_wandb=neox_args.use_wandb,
+        tensorboard_writer=neox_args.tensorboard_writer,
+    )
 
-        for key in total_loss_dict:
-            if key not in [skipped_iters_key, got_nan_key]:
-                v = (
-                    total_loss_dict[key].item()
-                    if hasattr(total_loss_dict[key], "item")
-                    else total_loss_dict[key]
-                )
-                avg = v / float(num_iterations)
-                log_string += " {}: {:.6E} |".format(key, avg)
-                total_loss_dict[key] = 0.0
-        if neox_args.precision == "fp16":
-            log_string += " loss scale: {:.1f} |".format(loss_scale)
-        log_string += " number of skipped iterations: {:3d} |".format(
-            total_loss_dict[skipped_iters_key]
-        )
-        log_string += " number of nan iterations: {:3d} |".format(
-            total_loss_dict[got_nan_key]
-        )
-        total_loss_dict[skipped_iters_key] = 0
-        total_loss_dict[got_nan_key] = 0
-        print_rank_0(log_string)
-        if report_memory_flag:
-            report_memory("after {} iterations".format(iteration))
-            report_memory_flag = False
-
-        timers.log(timers_to_log, normalizer=neox_args.log_interval)
+    for key in total_loss_dict:
+        if key not in [skipped_iters_key, got_nan_key]:
+            v = (
+                total_loss_dict[key].item()
+                if hasattr(total_loss_dict[key], "item")
+                else total_loss_dict[key]
+            )
+            avg = v / float(num_iterations)
+            log_string += " {}: {:.6E} |".format(key, avg)
+            total_loss_dict[key] = 0.0
+    if neox_args.precision == "fp16":
+        log_string += " loss scale: {:.1f} |".format(loss_scale)
+    log_string += " number of skipped iterations: {:3d} |".format(
+        total_loss_dict[skipped_iters_key]
+    )
+    log_string += " number of nan iterations: {:3d} |".format(
+        total_loss_dict[got_nan_key]
+    )
+    total_loss_dict[skipped_iters_key] = 0
+    total_loss_dict[got_nan_key] = 0
+    print_rank_0(log_string)
+    if report_memory_flag:
+        report_memory("after {} iterations".format(iteration))
+        report_memory_flag = False
+
+    timers.log(timers_to_log, normalizer=neox_args.log_interval)
 
     return report_memory_flag
 
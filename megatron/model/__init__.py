@@ -16,5 +16,9 @@
 # limitations under the License.
 
 from .gpt2_model import GPT2ModelPipe
-from .utils import get_params_for_weight_decay_optimization
+from .utils import (
+    get_params_for_weight_decay_optimization,
+    get_train_mode_sensitive_modules,
+    set_train_mode,
+)
 from .word_embeddings import SoftEmbedding
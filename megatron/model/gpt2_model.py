@@ -49,7 +49,7 @@ def gpt2_attention_mask_func(attention_scores, ltor_mask):
     return attention_scores
 
 
-def cross_entropy(output, labels, _fp16=False):
+def cross_entropy(output, labels, _fp16=False, workspace=None):
     """From pretrain_gpt2:forward_step()"""
     """
     if self.fp16_lm_cross_entropy:
@@ -60,11 +60,20 @@ def cross_entropy(output, labels, _fp16=False):
         return loss
     """
     labels, loss_mask = labels[0], labels[1]
+    # batches are int32, but older versions of torch can only index with int64
+    labels = labels.long()
     if _fp16:
         assert output.dtype == torch.half and loss_mask.dtype == torch.half
         losses = mpu.vocab_parallel_cross_entropy(output.contiguous(), labels)
     else:
-        losses = mpu.vocab_parallel_cross_entropy(output.float().contiguous(), labels)
+        if workspace is not None and output.dtype != torch.float:
+            # upcast into the preallocated float32 workspace rather than a new tensor. It's overwritten
+            # in place, so it can only be reused once the backward pass of the previous call has run.
+            # (detach() gives a new tensor sharing its memory, so autograd history isn't chained onto it)
+            logits = workspace.detach().copy_(output)
+        else:
+            logits = output.float()
+        losses = mpu.vocab_parallel_cross_entropy(logits.contiguous(), labels)
     loss_mask = loss_mask.view(-1)
     loss = torch.sum(losses.view(-1) * loss_mask) / loss_mask.sum()
     return loss
@@ -191,6 +191,42 @@ def _set_use_cache(modules, value: bool):
     recursive_setattr(modules, "use_cache", value, assert_type=bool)
 
 
+def get_train_mode_sensitive_modules(module):
+    """
+    Returns `module` and those of its submodules that behave differently in train / eval mode - dropout, batchnorm,
+    and transformer layers (which pick their bias-dropout-add function based on `self.training`).
+    `set_train_mode` only switches these modules rather than walking the whole module tree, so the `.training` flag
+    of every other module is left as it was.
+    """
+    from megatron.model.transformer import ParallelTransformerLayer
+
+    sensitive_types = (
+        torch.nn.Dropout,
+        torch.nn.modules.batchnorm._BatchNorm,
+        ParallelTransformerLayer,
+    )
+    return [module] + [
+        m
+        for m in module.modules()
+        if m is not module and isinstance(m, sensitive_types)
+    ]
+
+
+def set_train_mode(model, mode: bool):
+    """
+    Sets train mode to `mode` on a deepspeed engine wrapping a model from `get_model`. Only the modules collected
+    by `get_train_mode_sensitive_modules` are switched, all others keep their current `.training` flag.
+    Falls back to `model.train(mode)` for other models.
+    """
+    modules = getattr(model.module, "train_mode_sensitive_modules", None)
+    if modules is None:
+        model.train(mode)
+        return
+    model.training = mode
+    for m in modules:
+        m.training = mode
+
+
 def configure_sparse_attention(neox_args, attention_type, num_attention_heads, mpu):
     from deepspeed.ops.sparse_attention import (
         SparseSelfAttention,
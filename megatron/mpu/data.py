@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
+
 import torch
 
 from .initialize import get_model_parallel_group
@@ -21,6 +23,9 @@ from .initialize import get_model_parallel_src_rank
 
 _MAX_DATA_DIM = 4
 
+# (numel, dtype) -> deque of reusable flat buffers for broadcast_data
+_BROADCAST_BUFFERS = {}
+
 
 def _check_data_types(keys, data, target_dtype):
     """Check that all the keys have the same target data type."""
@@ -76,6 +81,30 @@ def _build_key_size_numel_dictionaries(keys, data):
     return key_size, key_numel, total_numel
 
 
+def preallocate_broadcast_buffers(numel, datatype, num_buffers):
+    """Preallocate `num_buffers` flat buffers that broadcast_data cycles through
+    (instead of allocating a new one every call) when broadcasting `numel`
+    elements of `datatype`.
+
+    The tensors returned by broadcast_data are views into these buffers, so
+    they're only valid until another `num_buffers` batches of the same size
+    have been broadcast.
+    """
+    _BROADCAST_BUFFERS[(numel, datatype)] = deque(
+        torch.empty(numel, device=torch.cuda.current_device(), dtype=datatype)
+        for _ in range(num_buffers)
+    )
+
+
+def _get_broadcast_buffer(numel, datatype):
+    """Get the next preallocated buffer for `numel` elements of `datatype`, if there is one."""
+    buffers = _BROADCAST_BUFFERS.get((numel, datatype))
+    if not buffers:
+        return None
+    buffers.rotate(-1)
+    return buffers[-1]
+
+
 def broadcast_data(keys, data, datatype):
     """Broadcast data from rank zero of each model parallel group to the
     members of the same model parallel group.
@@ -89,16 +118,26 @@ def broadcast_data(keys, data, datatype):
     # Build (key, size) and (key, number of elements) dictionaries along
     # with the total number of elements on all ranks.
     key_size, key_numel, total_numel = _build_key_size_numel_dictionaries(keys, data)
+    flatten_data = _get_broadcast_buffer(int(total_numel), datatype)
 
     # Pack on rank zero.
     if get_model_parallel_rank() == 0:
         # Check that all keys have the same data type.
         _check_data_types(keys, data, datatype)
         # Flatten the data associated with the keys
-        flatten_data = torch.cat(
-            [data[key].contiguous().view(-1) for key in keys], dim=0
-        ).cuda()
-    else:
+        if flatten_data is None:
+            flatten_data = torch.cat(
+                [data[key].contiguous().view(-1) for key in keys], dim=0
+            ).cuda()
+        else:
+            offset = 0
+            for key in keys:
+                numel = key_numel[key]
+                flatten_data.narrow(0, offset, numel).copy_(
+                    data[key].contiguous().view(-1), non_blocking=True
+                )
+                offset += numel
+    elif flatten_data is None:
         flatten_data = torch.empty(
             total_numel, device=torch.cuda.current_device(), dtype=datatype
         )
@@ -237,6 +237,22 @@ class NeoXArgsModel(NeoXArgsTemplate):
     Move the cross entropy unreduced loss calculation for lm head to fp16.
     """
 
+    preallocate_cross_entropy_workspace: bool = False
+    """
+    Preallocate a float32 buffer that the logits are upcast into for the cross entropy loss, and reuse it across
+    microbatches instead of allocating a new [batch, seq, vocab] tensor every time - reduces allocator fragmentation,
+    at the cost of keeping that buffer allocated for the whole of training. Has no effect with pipeline parallelism,
+    fp16_lm_cross_entropy or fp32 training.
+    """
+
+    use_compile: bool = False
+    """
+    Compile the model's forward pass and the cross entropy loss with torch.compile, to fuse pointwise ops. Only has an
+    effect when training without pipeline parallelism, and with a version of torch that has torch.compile. Falls back
+    to eager mode if compiling the forward pass fails - the backward pass is only compiled on the first backward
+    call, and a compiler failure there stops training.
+    """
+
     init_method_std: float = 0.02
     """
     Standard deviation of the zero mean normal distribution used for weight initialization.
@@ -761,6 +777,12 @@ class NeoXArgsTraining(NeoXArgsTemplate):
     Do not load rng state when loading checkpoint.
     """
 
+    prefetch_checkpoint: bool = False
+    """
+    Read the checkpoint files in `load` that this rank loads into the OS page cache on a background thread while the
+    optimizer and DeepSpeed engine are being built, so that loading the checkpoint afterwards does not wait on the filesystem.
+    """
+
     finetune: bool = False
     """
     Load model for finetuning. Do not load optimizer or rng state from checkpoint and set iteration to 0. Assumed when loading a release checkpoint.
@@ -872,6 +894,18 @@ class NeoXArgsTraining(NeoXArgsTemplate):
     Partition Activations across GPUs before checkpointing.
     """
 
+    use_expandable_segments: bool = None
+    """
+    Configure the CUDA caching allocator to use expandable (virtual memory backed) segments, which avoids large
+    reserved-but-unallocated gaps when training with activation checkpointing / pipeline parallelism.
+    Only has an effect with a torch version that supports it, and if PYTORCH_CUDA_ALLOC_CONF doesn't already
+    configure expandable segments. If left unset (None), expandable segments are used wherever they
+    are supported; set to True to also get a warning when they aren't, or False to turn them off.
+
+    WARNING: memory allocated from expandable segments can't be shared with cudaIpcGetMemHandle, so disable this if
+    anything in your setup shares allocator-owned tensors between processes with CUDA IPC.
+    """
+
     gas: int = None
     """gradient_accumulation_steps"""  # TODO this is a duplicate, remove?
 
@@ -139,7 +139,7 @@ def forward_model(model, model_inputs, is_pipe_parallel=False) -> torch.Tensor:
         # a) deepspeed pipeline only accepts iterables
         # b) deepspeed pipeline *requires* that you pass in labels for the loss, it's not easy to get around this
         # so we wrap the inputs in an iterable, and pad them (because internally, we get labels as inputs[:, 1:] and inputs as inputs[:, :-1])
-        model_inputs = iter([{"text": F.pad(model_inputs[0], pad=(0, 1))}])
+        model_inputs = iter([{"text": F.pad(model_inputs[0], pad=(0, 1)).int()}])
 
         # set num microbatches to 1 at inference time
         micro_batches_before = model.micro_batches
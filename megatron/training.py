@@ -31,8 +31,11 @@ import numpy as np
 
 from megatron.utils import (
     Timers,
+    compile_fn,
+    configure_cuda_allocator,
     init_wandb,
-    get_ltor_masks_and_position_ids,
+    get_cached_ltor_masks_and_position_ids,
+    get_loss_mask,
     reduce_losses,
 )
 
@@ -42,12 +45,18 @@ from megatron.model import (
     GPT2ModelPipe,
     SoftEmbedding,
     get_params_for_weight_decay_optimization,
+    get_train_mode_sensitive_modules,
+    set_train_mode,
+)
+from megatron.checkpointing import (
+    load_checkpoint,
+    prefetch_checkpoint,
+    save_checkpoint,
 )
-from megatron.checkpointing import load_checkpoint, save_checkpoint
 from megatron.data.data_utils import build_train_valid_test_data_iterators
 from megatron.initialize import initialize_megatron
 from megatron.learning_rates import AnnealingLR
-from megatron.logging import tb_wandb_log, training_log
+from megatron.logging import tb_wandb_log, training_log, accumulate_losses
 from megatron.utils import (
     OverflowMonitor,
     get_noise_scale_logger,
@@ -155,26 +164,83 @@ def _get_batch(neox_args, tokenizer, keys, data, datatype):
     data_b = mpu.broadcast_data(keys, data, datatype)
 
     # Unpack.
-    tokens_ = data_b["text"].long()
-    labels = tokens_[:, 1:].contiguous()
-    tokens = tokens_[:, :-1].contiguous()
-
-    # Get the masks and position ids.
-    attention_mask, loss_mask, position_ids = get_ltor_masks_and_position_ids(
-        data=tokens,
-        eod_token=neox_args.tokenizer.eod,
-        eod_mask_loss=neox_args.eod_mask_loss,
+    # tokens stay int32 (rather than int64) - halves the broadcast payload and is plenty for any vocab size.
+    tokens_ = data_b["text"]
+    # no need to copy into contiguous tensors - everything downstream handles strided views
+    labels = tokens_[:, 1:]
+    tokens = tokens_[:, :-1]
+
+    # Get the masks and position ids. These only depend on the batch shape, so they're cached
+    # across batches - unless we mask the loss at eod tokens, then the loss mask is built per batch.
+    batch_size, seq_length = tokens.size()
+    attention_mask, loss_mask, position_ids = get_cached_ltor_masks_and_position_ids(
+        batch_size=batch_size, seq_length=seq_length, device=tokens.device
     )
+    if neox_args.eod_mask_loss:
+        loss_mask = get_loss_mask(
+            data=tokens,
+            eod_token=neox_args.tokenizer.eod,
+            eod_mask_loss=neox_args.eod_mask_loss,
+        )
 
     return tokens, labels, loss_mask, attention_mask, position_ids
 
 
+class _BatchPrefetcher:
+    """
+    Wraps `data_iterator` and copies the following batch to the GPU on a side stream while the current one is being
+    used, so the host to device transfer overlaps with compute (cf. apex's `data_prefetcher`).
+
+    At most `num_batches` batches are pulled from `data_iterator`, so wrapping it doesn't change which batches end up
+    in which train step.
+    """
+
+    def __init__(self, data_iterator, num_batches):
+        self.data_iterator = data_iterator
+        self.num_batches = num_batches
+        self.num_preloaded = 0
+        self.stream = torch.cuda.Stream()
+        self.next_data = None
+
+    def preload(self):
+        """Fetch the next batch and start copying it to the GPU on the prefetch stream."""
+        if self.num_preloaded >= self.num_batches:
+            self.next_data = None
+            return
+        data = next(self.data_iterator)
+        with torch.cuda.stream(self.stream):
+            self.next_data = {
+                key: value.pin_memory().cuda(non_blocking=True)
+                if torch.is_tensor(value)
+                else value
+                for key, value in data.items()
+            }
+        self.num_preloaded += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_data is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.stream)
+        data = self.next_data
+        for value in data.values():
+            if torch.is_tensor(value):
+                # the memory was allocated on the prefetch stream - make sure the allocator
+                # doesn't reuse it while it's still being read on the current stream
+                value.record_stream(current_stream)
+        self.preload()
+        return data
+
+
 def get_batch(neox_args, data_iterator):
     """Generate a batch"""
 
     # Items and their type.
     keys = ["text"]
-    datatype = torch.int64
+    datatype = torch.int32
 
     # Broadcast data.
     if data_iterator is not None:
@@ -194,7 +260,7 @@ def get_batch_pipe(data, neox_args):
     """A modification of get_batch() to work with the latest batch instead of an iterator."""
     # Items and their type.
     keys = ["text"]
-    datatype = torch.int64
+    datatype = torch.int32
 
     tokens, labels, loss_mask, attention_mask, position_ids = _get_batch(
         neox_args, neox_args.tokenizer, keys, data, datatype
@@ -204,23 +270,53 @@ def get_batch_pipe(data, neox_args):
     return (tokens, position_ids, attention_mask), (labels, loss_mask)
 
 
+def get_cross_entropy_workspace(model, outputs):
+    """
+    Get the float32 buffer `cross_entropy` upcasts the logits into, (re)allocating it if it doesn't exist yet or
+    doesn't match the shape of `outputs`.
+
+    Only safe outside of pipeline parallelism, where each microbatch's backward pass runs before the next forward.
+    """
+    workspace = getattr(model, "cross_entropy_workspace", None)
+    if (
+        workspace is None
+        or workspace.shape != outputs.shape
+        or workspace.device != outputs.device
+    ):
+        workspace = torch.empty(outputs.shape, dtype=torch.float, device=outputs.device)
+        model.cross_entropy_workspace = workspace
+    return workspace
+
+
 def forward_step(data_iterator, model, neox_args, timers, return_logits=False):
     """Forward step."""
     if neox_args.is_pipe_parallel:
         return model.eval_batch(data_iterator, return_logits=return_logits)
 
     # Get the batch.
-    if timers is not None:
-        timers("batch generator").start()
+    batch_timer = timers("batch generator") if timers is not None else None
+    if batch_timer is not None:
+        batch_timer.start()
     tokens, labels, loss_mask, attention_mask, position_ids = get_batch(
         neox_args=neox_args, data_iterator=data_iterator
     )
-    if timers is not None:
-        timers("batch generator").stop()
+    if batch_timer is not None:
+        batch_timer.stop()
 
     outputs = model((tokens, position_ids, attention_mask))
-    loss = cross_entropy(
-        outputs, (labels, loss_mask), _fp16=neox_args.fp16_lm_cross_entropy
+    workspace = None
+    if (
+        neox_args.preallocate_cross_entropy_workspace
+        and not neox_args.fp16_lm_cross_entropy
+        and outputs.dtype != torch.float
+    ):
+        # fp32 logits aren't upcast, so they'd never use the workspace
+        workspace = get_cross_entropy_workspace(model=model, outputs=outputs)
+    loss = model.cross_entropy_fn(
+        outputs,
+        (labels, loss_mask),
+        _fp16=neox_args.fp16_lm_cross_entropy,
+        workspace=workspace,
     )
     if return_logits:
         return loss, outputs
@@ -265,6 +361,9 @@ def get_model(neox_args, use_cache=False):
         # Export PipeParallel model to nn.Sequential model to avoid the overhead of deepspeed's pipe parallel training
         model = model.to_sequential()
 
+    # so switching between train / eval mode doesn't have to recurse through every submodule
+    model.train_mode_sensitive_modules = get_train_mode_sensitive_modules(model)
+
     if neox_args.deepspeed:
         # DeepSpeed handles CUDA, FP16, and DDP components.
         return model
@@ -399,7 +498,16 @@ def get_learning_rate_scheduler(optimizer, neox_args):
 
 def setup_model_and_optimizer(neox_args, use_cache=False, iteration=None):
     """Setup model and optimizer."""
+    # must happen before the model is built so its weights / activations come from expandable segments
+    configure_cuda_allocator(neox_args=neox_args)
     model = get_model(neox_args=neox_args, use_cache=use_cache)
+    if neox_args.load is not None and neox_args.prefetch_checkpoint:
+        # overlap reading the checkpoint from disk with building the optimizer and engine
+        checkpoint_prefetch = prefetch_checkpoint(
+            neox_args=neox_args, model=model, iteration=iteration
+        )
+    else:
+        checkpoint_prefetch = None
     optimizer, param_groups = get_optimizer(model=model, neox_args=neox_args)
     lr_scheduler = get_learning_rate_scheduler(optimizer=optimizer, neox_args=neox_args)
 
@@ -426,13 +534,22 @@ def setup_model_and_optimizer(neox_args, use_cache=False, iteration=None):
         model.total_params = get_total_params(model.module)
         print_rank_0(f' > total params: {"{:,}".format(model.total_params)}')
 
+        # loss used by forward_step - with pipe parallelism, the engine uses GPT2ModelPipe's loss_fn instead
+        model.cross_entropy_fn = cross_entropy
         if neox_args.is_pipe_parallel:
             model.set_has_attention_mask(True)
             model.set_batch_fn(partial(get_batch_pipe, neox_args=neox_args))
+        elif neox_args.use_compile and not use_cache:
+            # the pipe engine schedules the forward pass itself, so we can only compile the sequential model.
+            # With use_cache (inference) the sequence length changes every step, which would recompile every time
+            model.module.forward = compile_fn(model.module.forward)
+            model.cross_entropy_fn = compile_fn(cross_entropy)
     else:
         raise ValueError("Must be using deepspeed to run neox")
 
     if neox_args.load is not None:
+        if checkpoint_prefetch is not None:
+            checkpoint_prefetch.result()
         neox_args.iteration = load_checkpoint(
             neox_args=neox_args,
             model=model,
@@ -446,6 +563,14 @@ def setup_model_and_optimizer(neox_args, use_cache=False, iteration=None):
     else:
         neox_args.iteration = 0
 
+    # reuse the same buffers for every broadcast batch rather than allocating new ones. Keep enough around that
+    # a buffer is only reused once the step it was loaded for (and the one after it) has finished with it.
+    mpu.preallocate_broadcast_buffers(
+        numel=neox_args.train_micro_batch_size_per_gpu * (neox_args.seq_length + 1),
+        datatype=torch.int32,
+        num_buffers=2 * neox_args.gradient_accumulation_steps,
+    )
+
     return model, optimizer, lr_scheduler
 
 
@@ -453,12 +578,13 @@ def backward_step(neox_args, timers, optimizer, model, loss):
     """Backward step."""
 
     # Backward pass.
-    timers("backward-backward").start()
+    backward_timer = timers("backward-backward", use_cuda_events=True)
+    backward_timer.start()
     if neox_args.deepspeed:
         model.backward(loss)
     else:
         raise ValueError("Must be using deepspeed to run neox")
-    timers("backward-backward").stop()
+    backward_timer.stop()
 
     if neox_args.deepspeed:
         # DeepSpeed backward propagation already addressed all reduce communication.
@@ -468,68 +594,84 @@ def backward_step(neox_args, timers, optimizer, model, loss):
         raise ValueError("Must be using deepspeed to run neox")
 
 
+def forward_backward_step(neox_args, timers, data_iterator, model, optimizer):
+    """Forward, backward and (deepspeed) optimizer step for a single microbatch. Returns the detached loss."""
+    loss = forward_step(
+        neox_args=neox_args,
+        timers=timers,
+        data_iterator=data_iterator,
+        model=model,
+    )
+    # Calculate gradients, reduce across processes, and clip.
+    backward_step(
+        neox_args=neox_args,
+        timers=timers,
+        optimizer=optimizer,
+        model=model,
+        loss=loss,
+    )
+    # Update parameters. deepspeed only actually steps the optimizer on gradient accumulation boundaries.
+    if neox_args.deepspeed:
+        model.step()
+    else:
+        raise ValueError("Must be using deepspeed to run neox")
+    return loss.detach()
+
+
 def train_step(neox_args, timers, data_iterator, model, optimizer, lr_scheduler):
     """Single training step."""
 
     # Pipeline parallelism schedules forward/backward/step
     if neox_args.is_pipe_parallel:
-        reduced_loss = train_step_pipe(
+        loss_dict = train_step_pipe(
             neox_args=neox_args, timers=timers, model=model, data_iterator=data_iterator
         )
     else:
-        losses = []
+        # accumulate microbatch losses in place rather than keeping one tensor per microbatch alive
+        loss_sum = torch.zeros((), device=torch.cuda.current_device())
+        # only the first rank of each model parallel group reads data, the others receive it via broadcast
+        if data_iterator is not None:
+            data_iterator = _BatchPrefetcher(
+                data_iterator, num_batches=neox_args.gradient_accumulation_steps
+            )
+            data_iterator.preload()
+        # time the accumulation loop as a whole rather than every microbatch. This times device work, which
+        # runs asynchronously, so use cuda events
+        forward_backward_timer = timers("forward-backward", use_cuda_events=True)
+        forward_backward_timer.start()
         for _ in range(neox_args.gradient_accumulation_steps):
-            # Forward model for one step.
-            timers("forward").start()
-            loss = forward_step(
+            loss = forward_backward_step(
                 neox_args=neox_args,
                 timers=timers,
                 data_iterator=data_iterator,
                 model=model,
-            )
-            timers("forward").stop()
-            losses.append(loss)
-            # Calculate gradients, reduce across processes, and clip.
-            timers("backward").start()
-            backward_step(
-                neox_args=neox_args,
-                timers=timers,
                 optimizer=optimizer,
-                model=model,
-                loss=loss,
             )
-            timers("backward").stop()
-            # Update parameters.
-            timers("optimizer").start()
-            if neox_args.deepspeed:
-                model.step()
-            else:
-                raise ValueError("Must be using deepspeed to run neox")
-            timers("optimizer").stop()
-        reduced_loss = {
-            "lm_loss": reduce_losses(losses).mean()
-        }  # reduces losses across machines for logging
+            loss_sum += loss
+        forward_backward_timer.stop()
+        # losses are only reduced across machines when they're logged (see training_log)
+        loss_dict = {"lm_loss": loss_sum / neox_args.gradient_accumulation_steps}
 
     if neox_args.precision == "fp16" and model.optimizer.overflow:
         skipped_iter = 1
     else:
         skipped_iter = 0
 
-    return reduced_loss, skipped_iter
+    return loss_dict, skipped_iter
 
 
 def train_step_pipe(neox_args, timers, model, data_iterator):
     """Single training step with DeepSpeed's pipeline parallel engine."""
 
     assert neox_args.deepspeed
-    loss = model.train_batch(data_iter=data_iterator)
+    # keep the loss on device - it's summed into the running totals on device and only
+    # moved to the cpu (one sync) when it's logged every `log_interval` iterations
+    loss = model.train_batch(data_iter=data_iterator).detach()
     loss_dict = {"lm_loss": loss}
     # Don't break Megatron's timers because we changed code paths.
     for t in [
-        "forward",
-        "backward",
+        "forward-backward",
         "allreduce",
-        "optimizer",
         "batch generator",
         "data loader",
     ]:
@@ -556,6 +698,7 @@ def train(
 
     # Iterations.
     iteration = neox_args.iteration
+    rank = torch.distributed.get_rank()
 
     timers("interval time").start()
     report_memory_flag = True
@@ -580,28 +723,37 @@ def train(
         if neox_args.log_gradient_noise_scale:  # log noise scale if applicable
             noise_scale_logger.update()
 
-        # get learning rate (if present) - if doing soft prompt tuning + pipe parallel, you
-        # may have no tunable parameters on a specific rank
-        if optimizer.param_groups:
-            lr = optimizer.param_groups[0].get("lr", 0)
-        else:
-            lr = 0
+        # Logging. Iterations that aren't logged only accumulate their losses.
+        if iteration % neox_args.log_interval == 0:
+            # get learning rate (if present) - if doing soft prompt tuning + pipe parallel, you
+            # may have no tunable parameters on a specific rank
+            if optimizer.param_groups:
+                lr = optimizer.param_groups[0].get("lr", 0)
+            else:
+                lr = 0
 
-        # Logging.
-        report_memory_flag = training_log(
-            neox_args=neox_args,
-            timers=timers,
-            loss_dict=loss_dict,
-            total_loss_dict=total_loss_dict,
-            learning_rate=lr,
-            iteration=iteration,
-            loss_scale=optimizer.cur_scale if neox_args.precision == "fp16" else None,
-            report_memory_flag=report_memory_flag,
-            skipped_iter=skipped_iter,
-            model=model,
-            optimizer=optimizer,
-            noise_scale_logger=noise_scale_logger,
-        )
+            report_memory_flag = training_log(
+                neox_args=neox_args,
+                timers=timers,
+                loss_dict=loss_dict,
+                total_loss_dict=total_loss_dict,
+                learning_rate=lr,
+                iteration=iteration,
+                loss_scale=optimizer.cur_scale
+                if neox_args.precision == "fp16"
+                else None,
+                report_memory_flag=report_memory_flag,
+                skipped_iter=skipped_iter,
+                model=model,
+                optimizer=optimizer,
+                noise_scale_logger=noise_scale_logger,
+            )
+        else:
+            accumulate_losses(
+                loss_dict=loss_dict,
+                total_loss_dict=total_loss_dict,
+                skipped_iter=skipped_iter,
+            )
 
         # Checkpointing
         if (
@@ -638,7 +790,6 @@ def train(
         if neox_args.exit_interval and iteration % neox_args.exit_interval == 0:
             torch.distributed.barrier()
             time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            rank = torch.distributed.get_rank()
             print_rank_0(
                 "rank: {} | time: {} | exiting the program at iteration {}".format(
                     rank, time_str, iteration
@@ -657,13 +808,15 @@ def evaluate(
     forward_step_fn: function with args `neox_args, timers,
                     data_iterator & model that will run a forward pass on the model
     data_iterator: Iterator that iterates over batches of data. Should return data in the form:
-                    {'text': np.array([tokens], dtype=np.int64)}
+                    {'text': np.array([tokens], dtype=np.int32)}
                     where the size of the array is the model's context size + 1
                     (`get_batch` transforms it into inputs / labels)
     """
     # Turn on evaluation mode which disables dropout.
-    model.eval()
-    losses = []
+    set_train_mode(model, False)
+    # keep a running sum on device rather than one tensor per microbatch
+    loss_sum = torch.zeros((), device=torch.cuda.current_device())
+    num_losses = 0
     if neox_args.char_level_ppl:
         data_iterator = CharCounter(data_iterator, neox_args.tokenizer)
 
@@ -691,7 +844,8 @@ def evaluate(
                     neox_args=neox_args,
                     timers=timers,
                 )
-                losses.append(loss)
+                loss_sum += loss.detach()
+                num_losses += 1
 
             # When contiguous memory optimizations are enabled, the buffers
             # allocated by the optimizations are deallocated during backward pass
@@ -701,7 +855,8 @@ def evaluate(
                 deepspeed.checkpointing.reset()
 
     # reduces losses across processes for logging & run eval harness tasks
-    eval_results = {"lm_loss": reduce_losses(losses).mean().item()}
+    # every rank runs the same number of eval steps, so averaging the per-rank means is exact
+    eval_results = {"lm_loss": reduce_losses([loss_sum / num_losses]).mean().item()}
     eval_results["lm_loss_ppl"] = math.exp(eval_results["lm_loss"])
 
     if neox_args.char_level_ppl:
@@ -723,7 +878,7 @@ def evaluate(
             ).get("results")
         )
     # Move model back to the train mode.
-    model.train()
+    set_train_mode(model, True)
     return eval_results
 
 
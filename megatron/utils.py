@@ -21,6 +21,7 @@ import sys
 import re
 import time
 import socket
+import functools
 from typing import Dict, List
 
 import requests
@@ -39,7 +40,12 @@ from collections import deque
 
 def reduce_losses(losses):
     """Reduce a tensor of losses across all GPUs."""
-    reduced_losses = torch.cat([loss.clone().detach().view(1) for loss in losses])
+    # stacking already copies, so the losses don't need to be cloned first. Always reduce in fp32 - the
+    # payload is a handful of scalars, so a smaller dtype saves nothing, but it would lose precision on
+    # sums of losses (e.g the logging interval totals)
+    reduced_losses = torch.stack(
+        [loss.detach().view(()).to(torch.float32) for loss in losses]
+    )
     torch.distributed.all_reduce(reduced_losses)
     reduced_losses = reduced_losses / torch.distributed.get_world_size()
     return reduced_losses
@@ -60,6 +66,66 @@ def report_memory(name):
     print_rank_0(string)
 
 
+def configure_cuda_allocator(neox_args):
+    """
+    Switches the CUDA caching allocator to expandable segments, unless `neox_args.use_expandable_segments` is False.
+
+    Expandable segments map physical memory into a single growing virtual address range instead of cudaMalloc-ing
+    fixed size blocks, so the allocator doesn't leave reserved-but-unallocated holes behind when allocation sizes
+    change between steps.
+
+    NOTE: memory in expandable segments can't be exported with cudaIpcGetMemHandle - code that shares
+    allocator-owned tensors across processes with CUDA IPC needs this to be turned off.
+    """
+    if neox_args.use_expandable_segments is False:
+        return
+    if "expandable_segments" in os.environ.get("PYTORCH_CUDA_ALLOC_CONF", ""):
+        # respect whatever the user has configured explicitly
+        return
+    try:
+        # older versions of torch have no setter, or a setter that doesn't know the expandable_segments option
+        torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+    except (AttributeError, RuntimeError):
+        # only worth a warning if the user asked for them, rather than on every run with the default config
+        if neox_args.use_expandable_segments:
+            print_rank_0(
+                "WARNING: this version of torch does not support expandable segments - using the default CUDA allocator"
+            )
+        return
+    print_rank_0("> enabled expandable segments in the CUDA caching allocator")
+
+
+def compile_fn(fn):
+    """
+    Wraps `fn` with torch.compile. Shapes are fixed during training, so we compile with `dynamic=False`.
+
+    If torch.compile isn't available, `fn` is returned unchanged, and if compiling `fn` fails the wrapper falls back
+    to running it eagerly from then on. That only covers the forward graph - the backward graph is compiled lazily
+    on the first backward pass, so a compiler failure there isn't caught and propagates from the backward call.
+    """
+    if not hasattr(torch, "compile"):
+        print_rank_0(
+            "WARNING: torch.compile is not available in this version of torch - running eagerly"
+        )
+        return fn
+    compiled = {"fn": torch.compile(fn, dynamic=False)}
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return compiled["fn"](*args, **kwargs)
+        except torch._dynamo.exc.TorchDynamoException as e:
+            # unsupported constructs become graph breaks, so what reaches us here is the compiler (e.g. inductor)
+            # itself failing on `fn`
+            print_rank_0(
+                f"WARNING: torch.compile does not support {fn.__name__} ({e}) - falling back to eager mode"
+            )
+            compiled["fn"] = fn
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
 def get_attn_mask(seq_length, device):
     """
     Get triangular attention mask for a given sequence length / device.
@@ -73,6 +139,40 @@ def get_attn_mask(seq_length, device):
     return mask < 0.5
 
 
+_LTOR_MASKS_AND_POSITION_IDS_CACHE = {}
+
+
+def get_cached_ltor_masks_and_position_ids(batch_size, seq_length, device):
+    """
+    Get the triangular attention mask, an all ones loss mask (i.e the loss mask without `eod_mask_loss`)
+    and position ids for a given batch size / sequence length / device.
+
+    None of these depend on the data, so they're built on the first call and reused afterwards.
+    The returned tensors are shared between calls and must not be modified in place.
+
+    Only the most recently used shape is kept, since training batches all have the same shape but e.g the eval harness
+    uses a different one for every request.
+    """
+    key = (batch_size, seq_length, device)
+    if key not in _LTOR_MASKS_AND_POSITION_IDS_CACHE:
+        _LTOR_MASKS_AND_POSITION_IDS_CACHE.clear()
+        position_ids = torch.arange(seq_length, dtype=torch.long, device=device)
+        _LTOR_MASKS_AND_POSITION_IDS_CACHE[key] = (
+            get_attn_mask(seq_length=seq_length, device=device),
+            torch.ones((batch_size, seq_length), dtype=torch.float, device=device),
+            position_ids.unsqueeze(0).expand(batch_size, seq_length),
+        )
+    return _LTOR_MASKS_AND_POSITION_IDS_CACHE[key]
+
+
+def get_loss_mask(data, eod_token, eod_mask_loss=False):
+    """Build the loss mask for left to right model."""
+    loss_mask = torch.ones(data.size(), dtype=torch.float, device=data.device)
+    if eod_mask_loss:
+        loss_mask[data == eod_token] = 0.0
+    return loss_mask
+
+
 def get_ltor_masks_and_position_ids(
     data,
     eod_token,
@@ -90,9 +190,9 @@ def get_ltor_masks_and_position_ids(
     )
 
     # Loss mask.
-    loss_mask = torch.ones(data.size(), dtype=torch.float, device=data.device)
-    if eod_mask_loss:
-        loss_mask[data == eod_token] = 0.0
+    loss_mask = get_loss_mask(
+        data=data, eod_token=eod_token, eod_mask_loss=eod_mask_loss
+    )
 
     # Position ids.
     position_ids = torch.arange(seq_length, dtype=torch.long, device=data.device)
@@ -215,32 +315,68 @@ def ddb(rank=0):
 
 
 class Timer:
-    """Timer."""
+    """
+    Timer.
 
-    def __init__(self, name):
+    Neither starting nor stopping a timer synchronizes the device. By default a timer measures wall clock time on
+    the host, which is what you want for host side work like fetching a batch. With `use_cuda_events`, it instead
+    records cuda events on the current stream, measuring how long the device takes to run the work queued between
+    start / stop. The recorded intervals are only resolved (and waited on if necessary) when `elapsed()` is called,
+    i.e at log time.
+    """
+
+    def __init__(self, name, use_cuda_events=False):
         self.name_ = name
+        self.use_cuda_events = use_cuda_events
         self.elapsed_ = 0.0
         self.started_ = False
-        self.start_time = time.time()
+        self.start_time = None
+        self.start_event = None
+        # (start, stop) event pairs that haven't been added to elapsed_ yet
+        self.pending_ = deque()
 
     def start(self):
         """Start the timer."""
         assert not self.started_, "timer has already been started"
-        torch.cuda.synchronize()
-        self.start_time = time.time()
+        if self.use_cuda_events:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        else:
+            self.start_time = time.perf_counter()
         self.started_ = True
 
     def stop(self):
         """Stop the timer."""
         assert self.started_, "timer is not started"
-        torch.cuda.synchronize()
-        self.elapsed_ += time.time() - self.start_time
         self.started_ = False
+        if not self.use_cuda_events:
+            self.elapsed_ += time.perf_counter() - self.start_time
+            return
+        stop_event = torch.cuda.Event(enable_timing=True)
+        stop_event.record()
+        self.pending_.append((self.start_event, stop_event))
+        self.start_event = None
+        # fold in whatever has already finished so pending_ doesn't grow between logs
+        self._collect(block=False)
+
+    def _collect(self, block):
+        """Add finished intervals to elapsed_. If `block`, wait for all pending intervals to finish first."""
+        while self.pending_:
+            start_event, stop_event = self.pending_[0]
+            if block:
+                stop_event.synchronize()
+            elif not stop_event.query():
+                # events complete in stream order, so nothing after this one has finished either
+                break
+            self.elapsed_ += start_event.elapsed_time(stop_event) / 1000.0
+            self.pending_.popleft()
 
     def reset(self):
         """Reset timer."""
         self.elapsed_ = 0.0
         self.started_ = False
+        self.start_event = None
+        self.pending_.clear()
 
     def elapsed(self, reset=True):
         """Calculate the elapsed time."""
@@ -249,6 +385,7 @@ class Timer:
         if self.started_:
             self.stop()
         # Get the elapsed time.
+        self._collect(block=True)
         elapsed_ = self.elapsed_
         # Reset the elapsed time
         if reset:
@@ -267,9 +404,10 @@ class Timers:
         self.use_wandb = use_wandb
         self.tensorboard_writer = tensorboard_writer
 
-    def __call__(self, name):
+    def __call__(self, name, use_cuda_events=False):
+        """Get the timer called `name`, creating it if it doesn't exist yet. See `Timer` for `use_cuda_events`."""
         if name not in self.timers:
-            self.timers[name] = Timer(name)
+            self.timers[name] = Timer(name, use_cuda_events=use_cuda_events)
         return self.timers[name]
 
     def write(self, names, iteration, normalizer=1.0, reset=False):
@@ -376,9 +514,10 @@ def get_noise_scale_logger(neox_args):
 
 
 def get_total_params(model):
-    # Print number of parameters.
+    # Print number of parameters. Only the first data parallel rank counts - the other
+    # data parallel ranks hold identical copies, and contribute 0 to the sum below.
     if mpu.get_data_parallel_rank() == 0:
-        params = sum([p.nelement() for p in model.parameters()])
+        params = sum(p.nelement() for p in model.parameters())
         print(
             " > number of parameters on model parallel rank {}: {}".format(
                 mpu.get_model_parallel_rank(), params
@@ -388,7 +527,8 @@ def get_total_params(model):
     else:
         params = 0
 
-    total_n_parameters = torch.tensor([params]).cuda(torch.cuda.current_device())
+    total_n_parameters = torch.tensor([params], device=torch.cuda.current_device())
+    # model / pipe parallel ranks each hold a different shard, so this has to be a sum, not a max
     torch.distributed.all_reduce(total_n_parameters)
     total_n_parameters = total_n_parameters.item()
     return total_n_parameters
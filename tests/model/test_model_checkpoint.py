@@ -115,6 +115,52 @@ def run_checkpoint_test(yaml_list=None, param_dict=None):
         assert params_equal, "run_checkpoint_test() params equal: " + str(n1)
 
 
+@pytest.mark.cpu
+def test_get_checkpoint_files(tmp_path):
+    from megatron.checkpointing import get_checkpoint_files
+
+    # a checkpoint of a 2 x 2 x 2 (pipe x data x model) run, with 6 pipe layers split evenly between the stages
+    names = [f"mp_rank_{i:02d}_model_states.pt" for i in range(4)]
+    names += [
+        f"layer_{idx:02d}-model_{mp:02d}-model_states.pt"
+        for idx in range(6)
+        for mp in range(2)
+    ]
+    names += [
+        f"zero_pp_rank_{dp}_mp_rank_{i:02d}_optim_states.pt"
+        for dp in range(2)
+        for i in range(4)
+    ]
+    for name in names:
+        (tmp_path / name).touch()
+
+    files = get_checkpoint_files(
+        checkpoint_dir=str(tmp_path),
+        pipe_rank=1,
+        model_rank=0,
+        model_parallel_size=2,
+        layer_indices=range(3, 6),
+    )
+    assert sorted(os.path.basename(f) for f in files) == [
+        "layer_03-model_00-model_states.pt",
+        "layer_04-model_00-model_states.pt",
+        "layer_05-model_00-model_states.pt",
+        "mp_rank_02_model_states.pt",
+        "zero_pp_rank_0_mp_rank_02_optim_states.pt",
+        "zero_pp_rank_1_mp_rank_02_optim_states.pt",
+    ]
+
+    # without loading the optimizer or pipe layers, only the engine states are read
+    files = get_checkpoint_files(
+        checkpoint_dir=str(tmp_path),
+        pipe_rank=0,
+        model_rank=1,
+        model_parallel_size=2,
+        load_optim=False,
+    )
+    assert [os.path.basename(f) for f in files] == ["mp_rank_01_model_states.pt"]
+
+
 if __name__ == "__main__":
     params = list(
         parametrize(
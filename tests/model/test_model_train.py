@@ -140,7 +140,7 @@ def run_train_test(yaml_list=None, param_dict=None):
     data_list = list()
     context_tokens_tensor = torch.randint(
         0, args_loaded.padded_vocab_size, (4, args_loaded.seq_length + 1)
-    ).to(torch.int64)
+    ).to(torch.int32)
     for i in range(max_steps):
         data_list.append({"text": context_tokens_tensor.clone()})
     data_iterator = iter(data_list)
@@ -172,3 +172,40 @@ def run_train_test(yaml_list=None, param_dict=None):
 
     if torch.distributed.get_world_size() == 1 or torch.distributed.get_rank() == 0:
         clear_test_dirs()
+
+
+@pytest.mark.cpu
+def test_accumulate_losses():
+    from megatron.logging import accumulate_losses, SKIPPED_ITERS_KEY, GOT_NAN_KEY
+
+    total_loss_dict = {}
+    for loss in [2.0, 3.0]:
+        accumulate_losses(
+            loss_dict={"lm_loss": torch.tensor(loss)},
+            total_loss_dict=total_loss_dict,
+            skipped_iter=0,
+        )
+    assert total_loss_dict["lm_loss"].item() == 5.0
+    assert total_loss_dict[SKIPPED_ITERS_KEY] == 0
+    assert total_loss_dict[GOT_NAN_KEY] == 0
+
+    # skipped iterations aren't added to the totals, but are counted - and so are their nans
+    for loss in [float("nan"), float("inf"), 1.0]:
+        accumulate_losses(
+            loss_dict={"lm_loss": torch.tensor(loss)},
+            total_loss_dict=total_loss_dict,
+            skipped_iter=1,
+        )
+    assert total_loss_dict["lm_loss"].item() == 5.0
+    assert total_loss_dict[SKIPPED_ITERS_KEY] == 3
+    assert total_loss_dict[GOT_NAN_KEY] == 2
+
+    # training_log resets the totals to 0.0 after logging them, tensors are summed into that
+    total_loss_dict["lm_loss"] = 0.0
+    accumulate_losses(
+        loss_dict={"lm_loss": torch.tensor(4.0)},
+        total_loss_dict=total_loss_dict,
+        skipped_iter=0,
+    )
+    assert torch.is_tensor(total_loss_dict["lm_loss"])
+    assert total_loss_dict["lm_loss"].item() == 4.0